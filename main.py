@@ -1,13 +1,45 @@
+# Patch the stdlib before anything opens sockets so Gemini/GCS calls yield
+from gevent import monkey
+monkey.patch_all()
+
+import grpc.experimental.gevent as grpc_gevent
+grpc_gevent.init_gevent()
+
+import io
 import os
-import json
+import re
 import logging
+import orjson
 import datetime
-from flask import Flask, request, redirect, render_template, url_for
+import threading
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from flask import Flask, Request, request, redirect, render_template, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
 from google.cloud import storage, secretmanager
+from google.cloud.exceptions import NotFound, PreconditionFailed
 import google.generativeai as genai
 
+# Request body limit; Werkzeug aborts larger bodies while parsing
+MAX_CONTENT_LENGTH = 10 * 1024 * 1024
+# An uploaded file is never larger than the body, so this keeps every accepted upload off disk
+SPOOL_MAX_SIZE = MAX_CONTENT_LENGTH
+
+class SpooledRequest(Request):
+    """Request that spools file uploads in memory instead of to disk."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode="rb+")
+
 # Flask App Initialization
 app = Flask(__name__)
+app.request_class = SpooledRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+
+# Only types the gallery lists and the upload form accepts; all are stored and sent as image/jpeg
+ALLOWED_MIME_TYPES = {"image/jpeg", "image/jpg"}
 
 # GCP Configurations
 bucket_name = os.getenv("GCS_BUCKET_NAME")
@@ -15,6 +47,41 @@ PROJECT_ID = "image-upload-gcp-project"
 SECRET_NAME = "GCS_SERVICE_ACCOUNT_KEY"
 GEMINI_SECRET_NAME = "GEMINI_API_KEY"
 
+# GCS upload tuning: objects up to the multipart limit go out in a single
+# request, larger ones use resumable uploads with 15 MiB chunks
+GCS_MULTIPART_LIMIT = 8 * 1024 * 1024
+GCS_CHUNK_SIZE = 15 * 1024 * 1024
+GCS_UPLOAD_TIMEOUT = 60
+
+# GCS caps custom object metadata at 8 KiB; longer AI output goes to a sidecar JSON
+GCS_CUSTOM_METADATA_LIMIT = 8 * 1024
+
+# Outcomes of set_image_metadata; a superseded image was replaced by a newer upload
+METADATA_ATTACHED = "attached"
+METADATA_SUPERSEDED = "superseded"
+METADATA_FAILED = "failed"
+
+# Concurrent requests per gevent worker; the Dockerfile passes the same value to gunicorn
+WORKER_CONNECTIONS = int(os.getenv("WORKER_CONNECTIONS", "1000"))
+
+# Shared pool for the independent network legs of an upload (Gemini, GCS).
+# Threads are greenlets under gevent and every upload holds two slots at once,
+# so size it for all worker connections uploading together.
+EXECUTOR_WORKERS = 2 * WORKER_CONNECTIONS
+EXECUTOR = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+
+# Short-lived cache of bucket listings for the index page, keyed by bucket
+IMAGE_LIST_CACHE = TTLCache(maxsize=16, ttl=30)
+IMAGE_LIST_LOCK = threading.Lock()
+
+# Signed URLs are reused until shortly before they expire
+SIGNED_URL_EXPIRATION = 3600
+SIGNED_URL_CACHE = TTLCache(maxsize=10000, ttl=SIGNED_URL_EXPIRATION - 60)
+SIGNED_URL_LOCK = threading.Lock()
+
+# Images are private, so only the browser may cache them, and no longer than a signed URL lives
+IMAGE_CACHE_CONTROL = f"private, max-age={SIGNED_URL_EXPIRATION}"
+
 # Configure Logging
 logging.basicConfig(level=logging.DEBUG)
 
@@ -25,14 +92,7 @@ def get_gcs_credentials():
     # Fetch GCS Service Account Key
     secret_path = f"projects/{PROJECT_ID}/secrets/{SECRET_NAME}/versions/latest"
     response = client.access_secret_version(request={"name": secret_path})
-    secret_json = response.payload.data.decode("UTF-8")
-
-    # Save to temporary file
-    temp_cred_path = "/tmp/gcs_service_account.json"
-    with open(temp_cred_path, "w") as f:
-        f.write(secret_json)
-
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = temp_cred_path
+    service_account_info = orjson.loads(response.payload.data)
 
     # Fetch Gemini API Key
     gemini_secret_path = f"projects/{PROJECT_ID}/secrets/{GEMINI_SECRET_NAME}/versions/latest"
@@ -45,87 +105,163 @@ def get_gcs_credentials():
         logging.error(f"Failed to retrieve Gemini API Key: {e}")
         raise
 
-    return temp_cred_path
+    return service_account_info
 
 # Initialize Google Cloud Clients
 def initialize_clients():
-    get_gcs_credentials()
-    return storage.Client()
+    # Credentials stay in memory; nothing is written to disk
+    client = storage.Client.from_service_account_info(get_gcs_credentials())
+    # Keep a connection per concurrent request alive; the requests default of 10
+    # would discard the rest and reconnect under gevent
+    client._http.mount("https://", HTTPAdapter(pool_maxsize=WORKER_CONNECTIONS))
+    return client
 
 storage_client = initialize_clients()
 
-def upload_to_gemini(path, mime_type="image/jpeg"):
-    """Uploads image to Gemini AI for processing."""
-    try:
-        file = genai.upload_file(path, mime_type=mime_type)
-        return file
-    except Exception as e:
-        logging.error(f"Failed to upload image to Gemini: {e}")
-        return None
+# Built once and shared across requests
+MODEL = genai.GenerativeModel(model_name="gemini-1.5-flash")
 
-def generative_ai(image_file):
+# Constrains JSON mode to the object the upload handler expects
+IMAGE_METADATA_SCHEMA = {
+    "type": "object",
+    "properties": {"title": {"type": "string"}, "description": {"type": "string"}},
+    "required": ["title", "description"],
+}
+
+# Markdown code fences Gemini may wrap around JSON despite JSON mode
+JSON_FENCE_PATTERN = re.compile(r"```(?:json)?\s*|\s*```")
+
+def generative_ai(image_bytes, mime_type="image/jpeg"):
     """Sends image to Gemini AI and retrieves title & description."""
     try:
-        model = genai.GenerativeModel(model_name="gemini-1.5-flash")
-        files = upload_to_gemini(image_file)
-        
-        if not files:
-            return {"title": "Upload Error", "description": "Failed to upload image to Gemini AI."}
-
-        chat_session = model.start_chat(
-            history=[{"role": "user", "parts": [files, "Generate title and description for the image and return as JSON"]}]
+        # Send the image inline with the prompt; genai.upload_file only accepts paths
+        image_part = {"mime_type": mime_type, "data": image_bytes}
+
+        response = MODEL.generate_content(
+            [image_part, 'Generate a title and description for the image. Return JSON with "title" and "description" keys.'],
+            generation_config={"response_mime_type": "application/json", "response_schema": IMAGE_METADATA_SCHEMA}
         )
+        response_text = response.text
+        logging.debug(f"Gemini API Response: {response_text}")
 
-        response = chat_session.send_message("Generate title and description in JSON format")
-        logging.debug(f"Gemini API Response: {response.text}")
+        try:
+            result = orjson.loads(response_text)
+        except orjson.JSONDecodeError:
+            # Only pay for the cleanup pass when the fast path fails
+            result = orjson.loads(JSON_FENCE_PATTERN.sub("", response_text).strip())
 
-        response_text = response.text.replace("```json", "").replace("```", "").strip()
-        return json.loads(response_text)
+        if not isinstance(result, dict):
+            logging.error("Gemini AI returned JSON that is not an object")
+            return {"title": "Invalid Response", "description": "Gemini AI returned an invalid response."}
+        return result
 
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         logging.error("Invalid JSON response from Gemini AI")
         return {"title": "Invalid Response", "description": "Gemini AI returned an invalid response."}
     except Exception as e:
         logging.error(f"Error in generative AI: {e}")
         return {"title": "Error", "description": "An error occurred while processing the image."}
 
-def upload_to_gcs(bucket_name, source_file, destination_blob_name):
-    """Uploads a file to Google Cloud Storage."""
+def upload_blob(blob, source_file, size=None, content_type=None):
+    """Uploads a file-like object, picking single-shot or chunked resumable by size."""
+    if size is None or size > GCS_MULTIPART_LIMIT:
+        blob.chunk_size = GCS_CHUNK_SIZE
+    blob.upload_from_file(source_file, size=size, content_type=content_type, rewind=True, timeout=GCS_UPLOAD_TIMEOUT)
+
+def upload_to_gcs(bucket_name, source_file, destination_blob_name, content_type=None, size=None, cache_control=None):
+    """Streams a file-like object to Google Cloud Storage, returning the new generation or None."""
     try:
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(destination_blob_name)
-        blob.upload_from_filename(source_file)
+        blob.cache_control = cache_control
+        upload_blob(blob, source_file, size=size, content_type=content_type)
+        logging.info(f"Uploaded {destination_blob_name} to GCS successfully.")
+        return blob.generation
+    except Exception as e:
+        logging.error(f"Failed to upload {destination_blob_name} to GCS: {e}")
+        return None
+
+def upload_json_to_gcs(bucket_name, payload, destination_blob_name):
+    """Uploads a small JSON payload to Google Cloud Storage in a single request."""
+    try:
+        bucket = storage_client.bucket(bucket_name)
+        blob = bucket.blob(destination_blob_name)
+        blob.chunk_size = None  # never take the resumable path for metadata
+        blob.upload_from_string(payload, content_type="application/json", timeout=GCS_UPLOAD_TIMEOUT)
         logging.info(f"Uploaded {destination_blob_name} to GCS successfully.")
         return True
     except Exception as e:
-        logging.error(f"Failed to upload {source_file} to GCS: {e}")
+        logging.error(f"Failed to upload {destination_blob_name} to GCS: {e}")
         return False
 
+def set_image_metadata(bucket_name, blob_name, metadata, generation):
+    """Attaches title & description to one uploaded generation of an image as custom metadata."""
+    try:
+        bucket = storage_client.bucket(bucket_name)
+        blob = bucket.blob(blob_name)
+        blob.metadata = {key: str(value) for key, value in metadata.items()}
+        # Never label a newer upload of the same name with this upload's metadata
+        blob.patch(if_generation_match=generation, timeout=GCS_UPLOAD_TIMEOUT)
+        logging.info(f"Updated metadata for {blob_name} in GCS successfully.")
+        return METADATA_ATTACHED
+    except PreconditionFailed:
+        logging.info(f"Skipped metadata for {blob_name}: generation {generation} was replaced by a newer upload.")
+        return METADATA_SUPERSEDED
+    except Exception as e:
+        logging.error(f"Failed to update metadata for {blob_name} in GCS: {e}")
+        return METADATA_FAILED
+
+def metadata_filename(filename, generation=None):
+    """Names the sidecar JSON for one generation of an image, or the legacy per-name sidecar."""
+    stem = os.path.splitext(filename)[0]
+    return f"{stem}.{generation}.json" if generation is not None else f"{stem}.json"
+
 def list_uploaded_images(bucket_name):
-    """Lists all images in the GCS bucket."""
+    """Lists all images in the GCS bucket, served from a short TTL cache."""
+    with IMAGE_LIST_LOCK:
+        images = IMAGE_LIST_CACHE.get(bucket_name)
+    if images is not None:
+        return images
+
     try:
         bucket = storage_client.bucket(bucket_name)
-        blobs = bucket.list_blobs()
-        return [blob.name for blob in blobs if blob.name.endswith(('.jpg', '.jpeg'))]
+        # Only object names are used, so skip the rest of the blob metadata
+        blobs = bucket.list_blobs(fields="items(name),nextPageToken")
+        images = [blob.name for blob in blobs if blob.name.endswith(('.jpg', '.jpeg'))]
     except Exception as e:
         logging.error(f"Failed to list images in GCS: {e}")
         return []
 
-def generate_temporary_url(bucket_name, blob_name, expiration=3600):
-    """Generates a signed URL to access private GCS images."""
+    with IMAGE_LIST_LOCK:
+        IMAGE_LIST_CACHE[bucket_name] = images
+    return images
+
+def invalidate_image_list(bucket_name):
+    """Drops the cached listing so a new upload shows up on the next page view."""
+    with IMAGE_LIST_LOCK:
+        IMAGE_LIST_CACHE.pop(bucket_name, None)
+
+def generate_temporary_url(bucket_name, blob_name, generation):
+    """Generates (or reuses a cached) signed URL to access one generation of a private GCS image."""
+    # A re-upload gets a new generation, hence a new URL the browser has not cached
+    key = (bucket_name, blob_name, generation)
+    with SIGNED_URL_LOCK:
+        url = SIGNED_URL_CACHE.get(key)
+    if url is not None:
+        return url
+
     try:
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(blob_name)
 
-        if not blob.exists(storage_client):
-            logging.error(f"File {blob_name} not found in GCS.")
-            return None
-
         url = blob.generate_signed_url(
             version="v4",
-            expiration=datetime.timedelta(seconds=expiration),
-            method="GET"
+            expiration=datetime.timedelta(seconds=SIGNED_URL_EXPIRATION),
+            method="GET",
+            generation=generation
         )
+        with SIGNED_URL_LOCK:
+            SIGNED_URL_CACHE[key] = url
         return url
     except Exception as e:
         logging.error(f"Failed to generate signed URL for {blob_name}: {e}")
@@ -142,11 +278,13 @@ def index():
 
 @app.route('/upload', methods=['POST'])
 def upload():
-    """Handles image upload, AI processing, and JSON metadata storage."""
+    """Handles image upload, AI processing, and metadata storage."""
     if not bucket_name:
         return "GCS_BUCKET_NAME is not set", 500
 
-    json_path, temp_path = None, None
+    # Reject oversized bodies before reading them
+    if request.content_length is not None and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        return "File too large", 413
 
     try:
         if 'image' not in request.files:
@@ -156,37 +294,50 @@ def upload():
         if file.filename == '':
             return "No file selected", 400
 
-        # Save file temporarily
-        temp_path = os.path.join('/tmp', file.filename)
-        file.save(temp_path)
+        if file.mimetype not in ALLOWED_MIME_TYPES:
+            return "Unsupported file type", 415
 
-        # Generate AI response
-        ai_response = generative_ai(temp_path)
+        # Keep the image in memory and share the bytes between both workers
+        image_bytes = file.read()
+
+        # Upload the image to GCS while Gemini processes it
+        fut_gcs = EXECUTOR.submit(upload_to_gcs, bucket_name, io.BytesIO(image_bytes), file.filename, content_type="image/jpeg", size=len(image_bytes), cache_control=IMAGE_CACHE_CONTROL)
+        fut_ai = EXECUTOR.submit(generative_ai, image_bytes, "image/jpeg")
+
+        ai_response = fut_ai.result()
         title = ai_response.get('title', 'No title present')
         description = ai_response.get('description', 'No description present')
 
-        # Save metadata as JSON
         json_data = {"title": title, "description": description}
-        json_filename = os.path.splitext(file.filename)[0] + '.json'
-        json_path = os.path.join('/tmp', json_filename)
-        with open(json_path, 'w') as json_file:
-            json.dump(json_data, json_file)
+        json_bytes = orjson.dumps(json_data)
+
+        # Metadata of either kind describes one image generation, so it needs the upload to finish
+        generation = fut_gcs.result()
+        if generation is None:
+            return "File upload failed", 500
+
+        # Per-generation sidecar, so a late writer can never clobber a newer upload's metadata
+        json_filename = metadata_filename(file.filename, generation)
+
+        if len(json_bytes) > GCS_CUSTOM_METADATA_LIMIT:
+            uploaded = upload_json_to_gcs(bucket_name, json_bytes, json_filename)
+        else:
+            # Fall back to the sidecar only on real failures; a superseded upload
+            # must leave the newer image's metadata alone
+            result = set_image_metadata(bucket_name, file.filename, json_data, generation)
+            uploaded = result != METADATA_FAILED or upload_json_to_gcs(bucket_name, json_bytes, json_filename)
 
-        # Upload to GCS
-        if not upload_to_gcs(bucket_name, temp_path, file.filename) or not upload_to_gcs(bucket_name, json_path, json_filename):
+        if not uploaded:
             return "File upload failed", 500
 
+        invalidate_image_list(bucket_name)
+
+    except RequestEntityTooLarge:
+        return "File too large", 413
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
         return "Internal Server Error", 500
 
-    finally:
-        # Cleanup temporary files
-        if temp_path and os.path.exists(temp_path):
-            os.remove(temp_path)
-        if json_path and os.path.exists(json_path):
-            os.remove(json_path)
-
     return redirect(url_for('view_image', filename=file.filename))
 
 @app.route('/view')
@@ -197,25 +348,40 @@ def view_image():
     if not filename:
         return "No file specified", 400
 
-    json_filename = os.path.splitext(filename)[0] + '.json'
     bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(json_filename)
-
-    if not blob.exists():
-        logging.error(f"Metadata file {json_filename} not found in bucket.")
-        return "Metadata not found", 404
+    image_blob = bucket.blob(filename)
 
     try:
-        json_data = json.loads(blob.download_as_text())
-    except json.JSONDecodeError:
-        logging.error(f"Invalid JSON in metadata file: {json_filename}")
-        return "Invalid metadata format", 500
+        image_blob.reload()
+    except NotFound:
+        logging.error(f"Image {filename} not found in bucket.")
+        return "Image not found", 404
+
+    json_data = image_blob.metadata or {}
+
+    # Long descriptions keep their metadata in a sidecar JSON for this generation;
+    # uploads from before per-generation sidecars use the plain <name>.json
+    if 'title' not in json_data:
+        for json_filename in (metadata_filename(filename, image_blob.generation), metadata_filename(filename)):
+            blob = bucket.blob(json_filename)
+
+            try:
+                json_data = orjson.loads(blob.download_as_bytes())
+                break
+            except NotFound:
+                continue
+            except orjson.JSONDecodeError:
+                logging.error(f"Invalid JSON in metadata file: {json_filename}")
+                return "Invalid metadata format", 500
+        else:
+            logging.error(f"Metadata for {filename} not found in bucket.")
+            return "Metadata not found", 404
 
     title = json_data.get('title', 'No title available')
     description = json_data.get('description', 'No description available')
 
     # Generate a temporary URL for secure access
-    temp_url = generate_temporary_url(bucket_name, filename)
+    temp_url = generate_temporary_url(bucket_name, filename, image_blob.generation)
     logging.debug(f"Generated Signed URL: {temp_url}")
 
     if not temp_url:
@@ -225,4 +391,5 @@ def view_image():
     return render_template('view.html', image_url=temp_url, title=title, description=description, bg_color=bg_color)
     
 if __name__ == '__main__':
-    app.run(port=8080, debug=True)
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(('0.0.0.0', 8080), app).serve_forever()